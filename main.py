@@ -1,8 +1,17 @@
 import streamlit as st
 import folium
 from streamlit_folium import st_folium
+import math
 import numpy as np
-from scipy.optimize import fsolve
+from scipy.optimize import least_squares
+
+# 위도 1°에 해당하는 거리와 적도에서 경도 1°에 해당하는 거리 (km)
+# 경도 1°의 거리는 위도에 따라 cos(위도)만큼 줄어듭니다.
+LAT_KM = 110.574
+LON_KM_EQUATOR = 111.320
+
+def lon_km(lat):
+    return LON_KM_EQUATOR * math.cos(math.radians(lat))
 
 # --- 1. 설정 및 인터페이스 ---
 st.set_page_config(page_title="지진 진앙지 결정 시뮬레이터", layout="wide")
@@ -16,29 +25,134 @@ st.markdown("""
 st.sidebar.header("⚒️ 지진파 속도 설정")
 vp = st.sidebar.number_input("P파 속도 (km/s)", value=6.0)
 vs = st.sidebar.number_input("S파 속도 (km/s)", value=3.5)
-k_factor = (vp * vs) / (vp - vs)
 
 # --- 2. 데이터 저장소 초기화 ---
 if 'stations' not in st.session_state:
     st.session_state.stations = []
+if 'station_keys' not in st.session_state:
+    st.session_state.station_keys = set()
+if 'last_click' not in st.session_state:
+    st.session_state.last_click = None
 
-# --- 3. 지도 및 관측소 설정 ---
-st.subheader("📍 단계 1: 지도에서 관측소 3곳 선택")
-c1, c2 = st.columns([2, 1])
+# PS시로부터 진원 거리(km)를 계산합니다.
+def compute_dist(vp, vs, ps):
+    return (vp * vs) / (vp - vs) * ps
 
-with c1:
-    m = folium.Map(location=[36.5, 127.5], zoom_start=7)
-    for i, s in enumerate(st.session_state.stations):
-        folium.Marker([s['lat'], s['lon']], tooltip=f"관측소 {i+1}", icon=folium.Icon(color="blue")).add_to(m)
-    
-    map_data = st_folium(m, width=700, height=500)
+# 목적 함수: 각 원까지의 거리와 진원 거리의 차이
+def residuals(p, sx, sy, d):
+    return np.hypot(p[0] - sx, p[1] - sy) - d
+
+# 목적 함수의 야코비안: 각 관측소에서 추정점으로 향하는 단위 벡터
+def jac(p, sx, sy, d):
+    dx, dy = p[0] - sx, p[1] - sy
+    r = np.hypot(dx, dy)
+    return np.stack([dx / r, dy / r], axis=1)
+
+# 관측소 좌표(km) 배열과 진원 거리 배열로 교점을 계산합니다.
+def trilaterate(sx, sy, d):
+    # 원의 방정식을 첫 번째 원에서 빼면 x, y에 대한 선형 방정식이 됩니다.
+    # 2(x_i-x_0)x + 2(y_i-y_0)y = (x_i²+y_i²-d_i²) - (x_0²+y_0²-d_0²)
+    A = 2 * np.stack([sx[1:] - sx[0], sy[1:] - sy[0]], axis=1)
+    b = (sx[1:]**2 + sy[1:]**2 - d[1:]**2) - (sx[0]**2 + sy[0]**2 - d[0]**2)
+    sol, _, rank, _ = np.linalg.lstsq(A, b, rcond=None)
+
+    # 세 관측소가 한 직선 위에 있으면 해가 하나로 정해지지 않습니다.
+    if rank < 2:
+        return None
+
+    # 세 원이 한 점에서 만나지 않으면 선형 해는 근사값이므로,
+    # 이를 초기값으로 거리 오차 제곱합을 최소화하는 점을 찾습니다.
+    result = least_squares(
+        residuals, sol, jac=jac, args=(sx, sy, d),
+        method='lm', x_scale='jac', xtol=1e-6, ftol=1e-6, max_nfev=30,
+    )
+    return result.x if result.success else sol
+
+# 관측소 위치와 PS시가 바뀔 때만 진앙을 다시 계산합니다.
+@st.cache_data
+def solve_epicenter(stations_key, vp, vs):
+    # 관측소 좌표(km)와 진원 거리를 배열로 미리 변환
+    # float32로도 정밀도가 유지되도록 첫 번째 관측소를 원점으로 하는 좌표를 사용합니다.
+    n = len(stations_key)
+    lat0, lon0, _ = stations_key[0]
+    # 경도 방향 축척은 관측소들의 평균 위도에서 한 번만 계산합니다.
+    lon_scale = lon_km(sum(lat for lat, _, _ in stations_key) / n)
+    sx = np.fromiter(((lon - lon0) * lon_scale for _, lon, _ in stations_key), dtype=np.float32, count=n)
+    sy = np.fromiter(((lat - lat0) * LAT_KM for lat, _, _ in stations_key), dtype=np.float32, count=n)
+    d = np.fromiter((compute_dist(vp, vs, ps) for _, _, ps in stations_key), dtype=np.float32, count=n)
+
+    sol = trilaterate(sx, sy, d)
+    if sol is None:
+        return None
+    return (float(lat0 + sol[1] / LAT_KM), float(lon0 + sol[0] / lon_scale))
+
+# 진원 거리 원을 위도·경도 꼭짓점 배열로 미리 계산해 다각형으로 그립니다.
+@st.cache_data
+def circle_poly(lat, lon, radius_km, lon_scale, n=64):
+    theta = np.linspace(0, 2 * np.pi, n)
+    dlat = radius_km / LAT_KM * np.cos(theta)
+    dlon = radius_km / lon_scale * np.sin(theta)
+    return list(zip((lat + dlat).tolist(), (lon + dlon).tolist()))
+
+# st_folium이 지도를 그릴 때 지도 객체를 변경하므로, 지도는 캐시하지 않고 실행할 때마다 새로 만듭니다.
+def station_map(stations_key, result_key=None):
+    # 진앙이 계산되면 예측 진앙을 지도 중심으로 합니다.
+    location = [36.5, 127.5] if result_key is None else [result_key[1], result_key[2]]
+    m = folium.Map(location=location, zoom_start=7)
+    # 마커는 FeatureGroup에 모아 지도에는 한 번만 추가합니다.
+    if stations_key:
+        station_layer = folium.FeatureGroup(name='stations')
+        for i, (lat, lon) in enumerate(stations_key):
+            folium.Marker([lat, lon], tooltip=f"관측소 {i+1}", icon=folium.Icon(color="blue")).add_to(station_layer)
+        station_layer.add_to(m)
+
+    # 관측소 3곳이 모두 정해지면 진원 거리 원과 예측 진앙을 같은 지도에 겹쳐 그립니다.
+    if result_key is not None:
+        dists, res_lat, res_lon = result_key
+        result_layer = folium.FeatureGroup(name='result')
+        # 원이 예측 진앙에서 만나도록 진앙 계산과 같은 평균 위도의 경도 축척을 사용합니다.
+        lon_scale = lon_km(sum(lat for lat, _ in stations_key) / len(stations_key))
+
+        for (lat, lon), dist in zip(stations_key, dists):
+            folium.Polygon(
+                circle_poly(lat, lon, dist, lon_scale), 
+                color='blue', 
+                fill=True, 
+                fill_opacity=0.1
+            ).add_to(result_layer)
+
+        folium.Marker(
+            [res_lat, res_lon], 
+            popup=f"예측 진앙지", 
+            icon=folium.Icon(color='red', icon='star')
+        ).add_to(result_layer)
+        result_layer.add_to(m)
+    return m
+
+# 콜백은 스크립트가 다시 실행되기 전에 처리되므로 st.rerun()을 따로 호출하지 않습니다.
+def add_station():
+    clicked = st.session_state.picker_map.get('last_clicked')
+    # 이미 처리한 클릭은 무시합니다.
+    if not clicked or clicked == st.session_state.last_click:
+        return
+    st.session_state.last_click = clicked
 
     # 클릭 시 관측소 추가
-    if map_data['last_clicked'] and len(st.session_state.stations) < 3:
-        new_lat, new_lon = map_data['last_clicked']['lat'], map_data['last_clicked']['lng']
-        if not any(s['lat'] == new_lat for s in st.session_state.stations):
+    if len(st.session_state.stations) < 3:
+        new_lat, new_lon = clicked['lat'], clicked['lng']
+        # 소수점 5자리(약 1 m)로 반올림한 좌표로 같은 지점의 중복 클릭을 걸러냅니다.
+        key = (round(new_lat, 5), round(new_lon, 5))
+        if key not in st.session_state.station_keys:
+            st.session_state.station_keys.add(key)
             st.session_state.stations.append({'lat': new_lat, 'lon': new_lon, 'ps': 5.0})
-            st.rerun()
+
+def reset_stations():
+    st.session_state.stations = []
+    st.session_state.station_keys = set()
+
+# --- 3. 지도 및 관측소 설정 ---
+st.subheader("📍 단계 1: 지도에서 관측소 3곳 선택")
+c1, c2 = st.columns([2, 1])
 
 with c2:
     st.write("### 관측소 목록 및 TS시 입력")
@@ -51,13 +165,35 @@ with c2:
             value=float(st.session_state.stations[i]['ps']),
             key=f"input_ps_{i}"
         )
-        dist = k_factor * st.session_state.stations[i]['ps']
+        dist = compute_dist(vp, vs, st.session_state.stations[i]['ps'])
         st.session_state.stations[i]['dist'] = dist
         st.caption(f"계산된 진원 거리: {dist:.2f} km")
 
-    if st.button("관측소 초기화"):
-        st.session_state.stations = []
-        st.rerun()
+    st.button("관측소 초기화", on_click=reset_stations)
+
+# 관측소 3곳이 모두 정해지면 지도를 그리기 전에 진앙을 먼저 계산합니다.
+epicenter = None
+if len(st.session_state.stations) == 3:
+    epicenter = solve_epicenter(
+        tuple((s['lat'], s['lon'], s['ps']) for s in st.session_state.stations), vp, vs
+    )
+
+with c1:
+    stations_key = tuple((s['lat'], s['lon']) for s in st.session_state.stations)
+    result_key = None
+    if epicenter is not None:
+        result_key = (
+            tuple(s['dist'] for s in st.session_state.stations),
+            round(epicenter[0], 6),
+            round(epicenter[1], 6),
+        )
+    m = station_map(stations_key, result_key)
+    
+    # 클릭 위치만 돌려받아 지도 이동·확대 때마다 전체 지도 상태가 전송되지 않도록 합니다.
+    st_folium(
+        m, width=700, height=500, key="picker_map",
+        returned_objects=['last_clicked'], on_change=add_station,
+    )
 
 # --- 4. 계산 과정 설명 (Markdown) ---
 st.divider()
@@ -66,7 +202,7 @@ with st.expander("🔍 계산 원리 및 오차 발생 원인 자세히 보기")
     # 1. 기본 수식 설명
     st.markdown("#### 1. 진원 거리($d$) 계산")
     st.latex(r"d = \frac{V_p \times V_s}{V_p - V_s} \times PS")
-    st.write(f"현재 설정된 상수값($V_p={vp}, V_s={vs}$)에 따라, $d \approx PS \times {k_factor:.2f}$ km 입니다.")
+    st.write(f"현재 설정된 상수값($V_p={vp}, V_s={vs}$)에 따라, $d \approx PS \times {compute_dist(vp, vs, 1.0):.2f}$ km 입니다.")
     
     st.divider()
 
@@ -110,53 +246,11 @@ with st.expander("🔍 계산 원리 및 오차 발생 원인 자세히 보기")
 # --- 5. 교점 계산 및 시각화 ---
 if len(st.session_state.stations) == 3:
     st.subheader("🎯 단계 3: 진앙지 작도 및 결과")
-    
-    from scipy.optimize import least_squares
-    import math
-
-    # 목적 함수 정의
-    def residuals(p, stations):
-        x, y = p
-        res = []
-        for s in stations:
-            sx, sy = s['lon'] * 88.8, s['lat'] * 111.0 
-            current_dist = math.sqrt((x - sx)**2 + (y - sy)**2)
-            res.append(current_dist - s['dist'])
-        return res
-
-    # 초기값 계산
-    avg_lon = sum(s['lon'] for s in st.session_state.stations) / 3 * 88.8
-    avg_lat = sum(s['lat'] for s in st.session_state.stations) / 3 * 111.0
-    
-    # 최적화 실행
-    result = least_squares(residuals, [avg_lon, avg_lat], args=(st.session_state.stations,))
-    
-    if result.success:
-        res_lon, res_lat = result.x[0] / 88.8, result.x[1] / 111.0
-
-        # 결과 지도 시각화
-        res_map = folium.Map(location=[res_lat, res_lon], zoom_start=7)
-        
-        for s in st.session_state.stations:
-            folium.Marker([s['lat'], s['lon']], icon=folium.Icon(color='blue')).add_to(res_map)
-            folium.Circle(
-                [s['lat'], s['lon']], 
-                radius=s['dist'] * 1000, 
-                color='blue', 
-                fill=True, 
-                fill_opacity=0.1
-            ).add_to(res_map)
-        
-        folium.Marker(
-            [res_lat, res_lon], 
-            popup=f"예측 진앙지", 
-            icon=folium.Icon(color='red', icon='star')
-        ).add_to(res_map)
 
-        # 주의: 여기서 괄호가 잘 닫혔는지 확인하세요!
-        st_folium(res_map, width=900, height=500, key="result_map")
-        
+    if epicenter is not None:
+        res_lat, res_lon = epicenter
         st.success(f"✅ 계산 완료! 예측 진앙 위치: 북위 {res_lat:.4f}°, 경도 {res_lon:.4f}°")
+        st.caption("진원 거리 원과 예측 진앙은 단계 1의 지도에 함께 표시됩니다.")
     else:
         st.error("진앙지를 계산하는 데 실패했습니다.")
 